@@ -864,10 +864,18 @@ class PalmForPreTraining(PreTrainedBertModel):
                 attention_mask,
                 output_all_encoded_layers=False,
                 checkpoint_activations=checkpoint_activations)
-            prediction_scores, seq_relationship_score = self.cls(
-                sequence_output, pooled_output)
+            encoder_output = sequence_output
+            if is_infer:
+                # The encoder LM head is not used when decoding
+                prediction_scores = None
+            else:
+                prediction_scores, seq_relationship_score = self.cls(
+                    sequence_output, pooled_output)
         else:
+            # Decode step, the encoder output of the prompt is reused and not
+            # returned again, which spares FP16_Module an fp32 copy of it
             prediction_scores = None
+            encoder_output = None
             sequence_output = sequence_output.to(
                 dtype=next(self.decoder.parameters()).dtype)
         if attention_mask is None:
@@ -892,7 +900,7 @@ class PalmForPreTraining(PreTrainedBertModel):
             return prediction_scores, logits_parallel
         if is_infer:
             return prediction_scores, mpu.gather_from_model_parallel_region(
-                logits_parallel), sequence_output
+                logits_parallel), encoder_output
         return prediction_scores, mpu.gather_from_model_parallel_region(
             logits_parallel)
 
@@ -942,7 +950,8 @@ class PlugModel(torch.nn.Module):
             input_tokens (`torch.LongTensor` of shape `(batch_size, input_tokens_length)`):
                 `input_tokens_length` = `sequence_length`. Indices of input sequence tokens in the vocabulary.
                 Indices can be obtained using transformers [`BertTokenizer`]. See
-                [`TextGenerationPreprocessor.__call__`] for details.
+                [`TextGenerationPreprocessor.__call__`] for details. Can be None when `sequence_output` and
+                `attention_mask` are given, since the encoder is skipped.
             token_type_ids (`torch.LongTensor` of shape `(batch_size, input_tokens_length)`, *optional*, defaults to
             None):
                Segment token indices to indicate first and second portions of the inputs. Indices are selected in `[0,
@@ -983,7 +992,10 @@ class PlugModel(torch.nn.Module):
             defaults to None):
                 Also known as last_hidden_state. Sequence of hidden-states at the output of the last layer of the
                 model. A single forward() call can produce one single token. To generate the current token, the
-                sequence_output generated by the `forward()` of the previous token is required.
+                sequence_output generated by the `forward()` of the previous token is required. When given, the
+                encoder is skipped and only the decoder runs. It is cast to the dtype of the decoder, so passing it
+                in half precision avoids a conversion on every decoding step. In inference the encoder output
+                is only returned when it was computed, i.e. when `sequence_output` is None.
             parallel_output (`boolean`, *optional*, defaults to `True`):
                 To parallel return output, or gather it before return.
 
@@ -46,6 +46,7 @@ class PlugNLUConfig(PretrainedConfig):
                  warmup=0.0333,
                  pre_ln=True,
                  fp16=True,
+                 bf16=False,
                  fp32_layernorm=True,
                  fp32_embedding=False,
                  fp32_tokentypes=False,
@@ -73,10 +74,14 @@ class PlugNLUConfig(PretrainedConfig):
         self.warmup = warmup
         self.pre_ln = pre_ln
         self.fp16 = fp16
+        self.bf16 = bf16
+        assert not (fp16 and bf16)
         self.fp32_layernorm = fp32_layernorm
         self.fp32_embedding = fp32_embedding
         self.layernorm_epsilon = layernorm_epsilon
         self.fp32_tokentypes = fp32_tokentypes
+        # The embeddings are cast to fp16 when kept in fp32
+        assert not (bf16 and (fp32_embedding or fp32_tokentypes))
         self.dec_hidden_layers = dec_hidden_layers
         self.attn_separate = attn_separate
 
@@ -170,6 +175,9 @@ class PlugNLGConfig(PlugNLUConfig):
             Whether or not to apply LayerNorm to the input instead of the output in the blocks.
         fp16 (`boolean`, *optional*, defaults to `True`):
             Whether to use fp16 16-bit (mixed) precision training instead of 32-bit training.
+        bf16 (`boolean`, *optional*, defaults to `False`):
+            Whether to run the model natively in bf16 16-bit precision instead of 32-bit. Can not be combined
+            with `fp16`, `fp32_embedding` or `fp32_tokentypes`.
         fp32_layernorm (`boolean`, *optional*, defaults to `True`):
             Whether to use fp32 32-bit precision LayerNorm training while the argument `fp16` set to `True`.
         fp32_embedding (`boolean`, *optional*, defaults to `False`):
@@ -220,6 +228,7 @@ class PlugNLGConfig(PlugNLUConfig):
                  warmup=0.01,
                  pre_ln=True,
                  fp16=True,
+                 bf16=False,
                  fp32_layernorm=True,
                  fp32_embedding=False,
                  fp32_tokentypes=False,
@@ -245,9 +254,13 @@ class PlugNLGConfig(PlugNLUConfig):
         self.warmup = warmup
         self.pre_ln = pre_ln
         self.fp16 = fp16
+        self.bf16 = bf16
+        assert not (fp16 and bf16)
         self.fp32_layernorm = fp32_layernorm
         self.fp32_embedding = fp32_embedding
         self.layernorm_epsilon = layernorm_epsilon
         self.fp32_tokentypes = fp32_tokentypes
+        # The embeddings are cast to fp16 when kept in fp32
+        assert not (bf16 and (fp32_embedding or fp32_tokentypes))
         self.dec_hidden_layers = dec_hidden_layers
         self.attn_separate = attn_separate
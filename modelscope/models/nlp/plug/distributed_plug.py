@@ -1,10 +1,10 @@
 # Copyright (c) Alibaba, Inc. and its affiliates.
+import inspect
 from typing import Dict
 
 import torch
 from megatron_util import mpu, print_rank_0
 from megatron_util.fp16 import FP16_Module
-from torch.nn import functional as F
 
 from modelscope.models import TorchModel
 from modelscope.models.base import Tensor
@@ -12,10 +12,35 @@ from modelscope.utils.logger import get_logger
 from modelscope.utils.megatron_utils import init_megatron_util
 from modelscope.utils.nlp.load_checkpoint import pre_load
 from . import PlugModel
+from .backbone import BertLayerNorm
 from .configuration import PlugNLGConfig
 
+try:
+    from flashinfer.sampling import top_k_top_p_sampling_from_logits
+except ImportError:
+    top_k_top_p_sampling_from_logits = None
+
+
+def _takes_uniform_samples(func):
+    try:
+        return 'uniform_samples' in inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        # The signature can not be inspected, do not rely on it
+        return True
+
+
+# Before 0.2.3 the flashinfer sampler takes uniform samples as its second
+# argument and returns a (samples, success) tuple, the torch sampler is used
+# with those versions.
+if top_k_top_p_sampling_from_logits is not None and _takes_uniform_samples(
+        top_k_top_p_sampling_from_logits):
+    top_k_top_p_sampling_from_logits = None
+
 logger = get_logger()
 
+# Number of candidates kept by top-k before the top-p (nucleus) filtering
+TOP_P_CANDIDATES = 1024
+
 
 class DistributedPlug(TorchModel):
     """
@@ -71,6 +96,9 @@ class DistributedPlug(TorchModel):
 
         self.iteration = 0
         self.model = self.initialize_model(path_load_tag='model')
+        # Samplers with their static buffers and CUDA graphs, reused across
+        # generate() calls with the same batch size and sampling settings
+        self._samplers = {}
 
     def initialize_model(self, path_load_tag='model'):
         """Build the model."""
@@ -89,33 +117,50 @@ class DistributedPlug(TorchModel):
         # GPU allocation.
         model.cuda(torch.cuda.current_device())
 
+        # Bf16 runs natively, it has the range of fp32 so no loss scaling or
+        # fp32 embeddings are needed.
+        if self.config.bf16:
+            model.to(torch.bfloat16)
+            self.dtype = torch.bfloat16
+            if self.config.fp32_layernorm:
+                for module in model.modules():
+                    if isinstance(module, BertLayerNorm):
+                        module.float()
         # Fp16 conversion.
-        if self.config.fp16:
+        elif self.config.fp16:
             model = FP16_Module(model)
+            self.dtype = torch.half
+            embeddings = model.module.model.bert.embeddings
+            fp32_modules = []
             if self.config.fp32_embedding:
-                model.module.model.bert.embeddings.word_embeddings.float()
-                model.module.model.bert.embeddings.position_embeddings.float()
-                model.module.model.bert.embeddings.token_type_embeddings.float(
-                )
-            if self.config.fp32_tokentypes:
-                model.module.model.bert.embeddings.token_type_embeddings.float(
-                )
+                fp32_modules.extend([
+                    embeddings.word_embeddings, embeddings.position_embeddings,
+                    embeddings.token_type_embeddings
+                ])
+            elif self.config.fp32_tokentypes:
+                fp32_modules.append(embeddings.token_type_embeddings)
             if self.config.fp32_layernorm:
-                for name, _module in model.named_modules():
-                    if 'LayerNorm' in name:
-                        _module.float()
+                fp32_modules.extend(module for module in model.modules()
+                                    if isinstance(module, BertLayerNorm))
+            for module in fp32_modules:
+                module.float()
+        else:
+            self.dtype = torch.float
 
         load_model = pre_load(
             mpu.get_tensor_model_parallel_rank(),
             self.model_dir,
             tag=path_load_tag)
-        model_dict = model.module.model.state_dict()
-        for key in load_model:
-            if key not in model_dict.keys():
-                print_rank_0('Skip key: ' + key)
-            else:
-                print_rank_0('Loading key: ' + key)
-        model.module.model.load_state_dict(load_model, strict=False)
+        plug_model = model.module if isinstance(model, FP16_Module) else model
+        model_dict = plug_model.model.state_dict()
+        load_keys = set(load_model)
+        model_keys = set(model_dict)
+        skip_keys = load_keys - model_keys
+        print_rank_0('Skip {} keys, loading {} keys'.format(
+            len(skip_keys), len(load_keys & model_keys)))
+        if skip_keys:
+            logger.debug('Skip keys: {}'.format(', '.join(sorted(skip_keys))))
+        plug_model.model.load_state_dict(load_model, strict=False)
         return model
 
     @staticmethod
@@ -124,18 +169,28 @@ class DistributedPlug(TorchModel):
         # https://medium.com/huggingface/how-to-build-a-state-of-the-art-
         # conversational-ai-with-transfer-learning-2d818ac26313
 
+        if top_k <= 0 and top_p <= 0.0:
+            return logits
+
         if top_k > 0:
-            # Remove all tokens with a probability less than the last token of the top-k
-            indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1,
-                                                                      None]
-            logits[indices_to_remove] = filter_value
-
-        if top_p > 0.0:
-            # convert to 1D
-            logits = logits.view(logits.size()[1]).contiguous()
-            sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+            # Keep only the top-k tokens, everything else is set to filter_value
+            topk_logits, topk_indices = torch.topk(logits, top_k)
+            logits = torch.full_like(logits, filter_value).scatter_(
+                -1, topk_indices, topk_logits)
+
+        # top_p >= 1.0 keeps the whole vocab, it must not truncate it to the
+        # candidates below.
+        if 0.0 < top_p < 1.0:
+            # Only the most likely candidates are ranked instead of the whole
+            # vocab, the probabilities are still normalized over the full vocab.
+            # Tokens outside the candidates are always removed.
+            num_candidates = min(max(top_k, TOP_P_CANDIDATES), logits.size(-1))
+            # torch.topk returns the candidates sorted in descending order
+            sorted_logits, sorted_indices = torch.topk(logits, num_candidates)
             cumulative_probs = torch.cumsum(
-                F.softmax(sorted_logits, dim=-1), dim=-1)
+                torch.exp(sorted_logits
+                          - torch.logsumexp(logits, dim=-1, keepdim=True)),
+                dim=-1)
 
             # Remove tokens with cumulative probability above the threshold
             sorted_indices_to_remove = cumulative_probs > top_p
@@ -143,12 +198,113 @@ class DistributedPlug(TorchModel):
             sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[
                 ..., :-1].clone()
             sorted_indices_to_remove[..., 0] = 0
-            indices_to_remove = sorted_indices[sorted_indices_to_remove]
-            logits[indices_to_remove] = filter_value
-            # going back to 2D
-            logits = logits.view(1, -1).contiguous()
+            logits = torch.full_like(logits, filter_value).scatter_(
+                -1, sorted_indices,
+                sorted_logits.masked_fill(sorted_indices_to_remove,
+                                          filter_value))
         return logits
 
+    @staticmethod
+    def trim_generate_tokens(tokens, sep_token_idx=102, unk_token_idx=100):
+        """Cut the generated tokens of each sample before its first [SEP] and collapse runs of [UNK].
+
+        Args:
+            tokens (`torch.LongTensor` of shape `(batch_size, length)`): The generated tokens.
+            sep_token_idx (`int`, *optional*, defaults to 102): The index of the [SEP] token.
+            unk_token_idx (`int`, *optional*, defaults to 100): The index of the [UNK] token.
+
+        Returns:
+            A list with the token ids of each sample.
+        """
+        # Each sample ends before its first [SEP]
+        keep = tokens.eq(sep_token_idx).cumsum(dim=1) == 0
+        # Collapse runs of [UNK] into a single [UNK]
+        is_unk = tokens == unk_token_idx
+        keep[:, 1:] &= ~(is_unk[:, 1:] & is_unk[:, :-1])
+        return [sample[mask].tolist() for sample, mask in zip(tokens, keep)]
+
+    def _build_sampler(self, logits, temperature, top_k, top_p):
+        """Build the function sampling the next token from the logits of the last position.
+
+        The logits are copied into a static fp32 buffer, so the filtering and sampling kernels of the
+        Gumbel-max path can be captured once into a CUDA graph and replayed on every decoding step. The
+        model forward is not captured, since the decoder input grows by one token every step.
+
+        A banned token is added as -inf through a static mask. The Gumbel-max path applies it after the
+        top-k/top-p filtering, so the banned token is rejected from the filtered set like in resampling. The fused
+        flashinfer kernel can only take it before the filtering, which widens the filtered set slightly.
+        """
+        vocab_size = self.config.original_vocab_size
+        unk_token_idx = 100  # index of [UNK] token in BertTokenizer
+        static_logits = torch.empty_like(logits, dtype=torch.float)
+        ban_mask = torch.zeros_like(static_logits[:1])
+        banned = [None]
+
+        if top_k_top_p_sampling_from_logits is not None:
+
+            def sample_step():
+                # Fused top-k/top-p filtering and sampling in one kernel
+                prev = top_k_top_p_sampling_from_logits(
+                    static_logits / temperature + ban_mask,
+                    top_k=top_k if top_k > 0 else static_logits.size(-1),
+                    top_p=top_p if top_p > 0.0 else 1.0).long().unsqueeze(-1)
+                return prev.masked_fill_(prev >= vocab_size, unk_token_idx)
+        else:
+            gumbel_noise = torch.empty_like(static_logits)
+
+            def sample_step():
+                scaled_logits = static_logits / temperature
+                filtered_logits = self.top_k_logits(
+                    scaled_logits, top_k=top_k, top_p=top_p) + ban_mask
+                # When only banned tokens pass the filtering, e.g. with
+                # top_k=1, filter again with the banned tokens removed.
+                only_banned = (filtered_logits == -float('Inf')).all(
+                    dim=-1, keepdim=True)
+                filtered_logits = torch.where(
+                    only_banned,
+                    self.top_k_logits(
+                        scaled_logits + ban_mask, top_k=top_k, top_p=top_p),
+                    filtered_logits)
+                # Gumbel-max trick, the argmax of the logits plus Gumbel noise
+                # is a sample of softmax(logits).
+                gumbel_noise.uniform_().log_().neg_().log_().neg_()
+                prev = gumbel_noise.add_(filtered_logits).argmax(
+                    dim=-1, keepdim=True)
+                return prev.masked_fill_(prev >= vocab_size, unk_token_idx)
+
+        if top_k_top_p_sampling_from_logits is not None or not hasattr(
+                torch.cuda, 'CUDAGraph'):
+            run_step = sample_step
+        else:
+            static_logits.copy_(logits)
+            with torch.cuda.amp.autocast(enabled=False):
+                # Warm up on a side stream before capturing
+                stream = torch.cuda.Stream()
+                stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(stream):
+                    for _ in range(2):
+                        sample_step()
+                torch.cuda.current_stream().wait_stream(stream)
+                graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(graph):
+                    static_prev = sample_step()
+
+            def run_step():
+                graph.replay()
+                return static_prev
+
+        def sample(logits, banned_token=None):
+            # The returned tensor is overwritten by the next call
+            static_logits.copy_(logits)
+            if banned_token != banned[0]:
+                ban_mask.zero_()
+                if banned_token is not None:
+                    ban_mask[:, banned_token] = -float('Inf')
+                banned[0] = banned_token
+            return run_step()
+
+        return sample
+
     def forward(self,
                 input_tokens,
                 token_type_ids=None,
@@ -173,47 +329,114 @@ class DistributedPlug(TorchModel):
             parallel_output=parallel_output)
 
     def generate(self, input: Dict[str, Tensor], out_length=128, *kwargs):
-        device = torch.cuda.current_device()
+        """Sample continuations of the input texts.
+
+        All samples of the batch are decoded together, every step appends one token to each of them.
+        The generation stops once every sample has produced a [SEP] after the minimum length.
+
+        Args:
+            input (`Dict[str, Tensor]`): The `input_ids`, `attention_mask` of shape `(batch_size, seq_len)` and
+                the `dec_input_ids` of shape `(batch_size, 1)`.
+            out_length (`int`, *optional*, defaults to 128): The maximum number of tokens to generate.
+
+        Returns:
+            `Dict[str, List]`: The generated token ids under `generate_context`, a list of ids when batch_size
+                is 1, otherwise one list of ids per sample.
+        """
+        device = torch.device('cuda', torch.cuda.current_device())
+
+        def to_device(tensor):
+            # Inputs already on the device are used as they are, copies from
+            # pinned host memory can overlap with the first forward.
+            if tensor.device == device:
+                return tensor
+            return tensor.to(device, non_blocking=True)
+
         batch_size = input['input_ids'].shape[0]
-        tokens = input['input_ids'].view(1, -1).contiguous().to(device)
-        dec_input_ids = input['dec_input_ids'].to(device)
-        attention_mask = input['attention_mask'].to(device)
+        tokens = input['input_ids'].view(batch_size, -1)
+        # tokens is updated in place by the sliding window, so it must not
+        # share memory with the input.
+        if tokens.device == device:
+            tokens = tokens.clone()
+        else:
+            tokens = to_device(tokens)
+        dec_input_ids = to_device(input['dec_input_ids'])
+        attention_mask = to_device(input['attention_mask'])
+        # fp32 models run without autocast
+        autocast_dtype = torch.bfloat16 \
+            if self.dtype == torch.bfloat16 else torch.float16
         self.model.eval()
-        with torch.no_grad():
-            # Only supports batch_size=1
-            all_generate_tokens = []
-            generate_tokens = []
+        with torch.inference_mode(), torch.cuda.amp.autocast(
+                enabled=self.dtype != torch.float, dtype=autocast_dtype):
+            # The sampled tokens stay on the device, the host only reads them
+            # back once the minimum length is reached to look for [SEP].
+            generate_buffer = torch.empty((batch_size, out_length),
+                                          dtype=torch.long,
+                                          device=device)
+            # The decoder inputs of a window are written into a preallocated
+            # buffer, the model gets a view of the filled part.
+            dec_start_length = dec_input_ids.size(1)
+            dec_buffer = dec_input_ids.new_empty(
+                (batch_size, dec_start_length + min(out_length, 128)))
+            dec_buffer[:, :dec_start_length] = dec_input_ids
+            window_length = tokens.size(1)
+            # Positions of the last [SEP] of each sample in tokens, tracked on
+            # the host so the tokens only have to be searched once.
+            sep_positions = None
+            position_ids = torch.empty((batch_size, 1),
+                                       dtype=torch.long,
+                                       device=device)
+            window_start = 0
             counter = 0
             sequence_output = None
-            vocab_size = self.config.original_vocab_size
             sep_token_idx = 102  # index of [SEP] token in BertTokenizer
+            unk_token_idx = 100  # index of [UNK] token in BertTokenizer
+            min_length = int(max(1, out_length) * 0.8)
+            temperature = self.model_cfg['temperature']
+            top_k = self.model_cfg['top_k']
+            top_p = self.model_cfg['top_p']
+            sampler = None
+            finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
             while counter < out_length:
                 if counter % 128 == 0 and counter != 0:
-                    # Sliding window
-                    generate_tokens.append(sep_token_idx)
-                    start = (tokens == sep_token_idx).nonzero(
-                        as_tuple=True)[-1]
-                    if start + len(generate_tokens) >= 512:
-                        tokens = torch.cat([
-                            tokens[:start],
-                            torch.cuda.LongTensor(generate_tokens)
-                        ], -1)[-512:]
-                    else:
-                        tokens[0][start:start + len(generate_tokens
-                                                    )] = torch.cuda.LongTensor(
-                                                        generate_tokens)
-
-                    attention_mask = (tokens != 0)
-                    dec_input_ids = input['dec_input_ids'].to(device)
-                    generate_tokens = []
+                    # Sliding window, the tokens generated in this window and
+                    # a [SEP] are written after the last [SEP] of each input.
+                    num_tokens = counter - window_start + 1
+                    if sep_positions is None:
+                        is_sep = tokens == sep_token_idx
+                        token_positions = torch.arange(
+                            window_length, device=device)
+                        sep_positions = (is_sep * token_positions).max(
+                            dim=1)[0].tolist()
+                        # The mask is updated in place together with tokens
+                        attention_mask = attention_mask.clone()
+                    for i in range(batch_size):
+                        start = sep_positions[i]
+                        if start + num_tokens >= window_length:
+                            # Shift the tokens to the left in place, the
+                            # oldest ones drop out of the window.
+                            shift = start + num_tokens - window_length
+                            tokens[i, :start
+                                   - shift] = tokens[i, shift:start].clone()
+                            start -= shift
+                        sep_positions[i] = start + num_tokens - 1
+                        tokens[i, start:sep_positions[i]] = generate_buffer[
+                            i, window_start:counter]
+                        tokens[i, sep_positions[i]] = sep_token_idx
+                        # The inputs are right padded, only the newly written
+                        # positions have to be unmasked.
+                        attention_mask[i, start:sep_positions[i] + 1] = 1
+
+                    window_start = counter
                     sequence_output = None
 
-                position_ids = torch.full([batch_size, 1],
-                                          len(generate_tokens),
-                                          dtype=torch.long,
-                                          device=device)
-                _, logits, sequence_output = self.model(
-                    tokens,
+                position_ids.fill_(counter - window_start)
+                dec_length = dec_start_length + counter - window_start
+                dec_input_ids = dec_buffer[:, :dec_length]
+                # Only the first step of a window runs the encoder on tokens,
+                # the following steps reuse its output.
+                _, logits, encoder_output = self.model(
+                    tokens if sequence_output is None else None,
                     None,
                     attention_mask,
                     dec_input_ids,
@@ -222,34 +445,37 @@ class DistributedPlug(TorchModel):
                     is_infer=True,
                     sequence_output=sequence_output,
                     parallel_output=False)
-                logits = logits[:, -1, :]
-                logits = logits / self.model_cfg['temperature']
-                logits = self.top_k_logits(
-                    logits,
-                    top_k=self.model_cfg['top_k'],
-                    top_p=self.model_cfg['top_p'])
-                log_probs = F.softmax(logits, dim=-1)
-                prev = torch.multinomial(log_probs, num_samples=1)
-                prev_token = prev[0].item()
-                if prev_token >= vocab_size:
-                    prev_token = 100
-                    prev[0] = 100
-                if prev_token == 102 and len(all_generate_tokens) > int(
-                        max(1, out_length) * 0.8):
-                    break
-                if prev_token == 102:
-                    counter += 1
-                    continue
-                dec_input_ids = torch.cat([dec_input_ids, prev], dim=1)
-                generate_tokens.append(prev_token)
-                all_generate_tokens.append(prev_token)
+                if sequence_output is None:
+                    # Keep the encoder output in the decoder precision for
+                    # the whole window, FP16_Module returns an fp32 copy.
+                    sequence_output = encoder_output.to(self.dtype)
+                next_token_logits = logits[:, -1]
+                if sampler is None:
+                    sampler_key = (batch_size, logits.size(-1), temperature,
+                                   top_k, top_p)
+                    sampler = self._samplers.get(sampler_key)
+                    if sampler is None:
+                        sampler = self._build_sampler(next_token_logits,
+                                                      temperature, top_k,
+                                                      top_p)
+                        self._samplers[sampler_key] = sampler
+                # [SEP] stops the generation, so it can not be sampled before
+                # the minimum length is reached.
+                can_stop = counter > min_length
+                prev = sampler(next_token_logits,
+                               None if can_stop else sep_token_idx)
+                dec_buffer[:, dec_length:dec_length + 1] = prev
+                generate_buffer[:, counter:counter + 1] = prev
                 counter += 1
+                if can_stop:
+                    # Checked on every step, a forward after all samples have
+                    # finished costs far more than the sync.
+                    finished |= prev[:, 0] == sep_token_idx
+                    if finished.all().item():
+                        break
 
-            generate_context = []
-            for token in all_generate_tokens:
-                if generate_context and generate_context[
-                        -1] == 100 and token == 100:
-                    continue
-                else:
-                    generate_context.append(token)
+            generate_context = self.trim_generate_tokens(
+                generate_buffer[:, :counter], sep_token_idx, unk_token_idx)
+            if batch_size == 1:
+                generate_context = generate_context[0]
             return {'generate_context': generate_context}
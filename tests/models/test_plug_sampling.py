@@ -0,0 +1,119 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+
+import unittest
+
+import torch
+import torch.nn.functional as F
+
+from modelscope.models.nlp.plug import DistributedPlug
+from modelscope.models.nlp.plug.distributed_plug import TOP_P_CANDIDATES
+
+SEP = 102
+UNK = 100
+
+
+def reference_top_k_logits(logits,
+                           top_k=0,
+                           top_p=0.0,
+                           filter_value=-float('Inf')):
+    # The full-sort implementation DistributedPlug.top_k_logits replaced,
+    # top_p only supports a batch size of 1
+    if top_k > 0:
+        threshold = torch.topk(logits, top_k)[0][..., -1, None]
+        indices_to_remove = logits < threshold
+        logits[indices_to_remove] = filter_value
+    if top_p > 0.0:
+        logits = logits.view(logits.size()[1]).contiguous()
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative_probs = torch.cumsum(
+            F.softmax(sorted_logits, dim=-1), dim=-1)
+        sorted_indices_to_remove = cumulative_probs > top_p
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[
+            ..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = 0
+        indices_to_remove = sorted_indices[sorted_indices_to_remove]
+        logits[indices_to_remove] = filter_value
+        logits = logits.view(1, -1).contiguous()
+    return logits
+
+
+def reference_trim(tokens):
+    # The token by token loop of the original generate()
+    kept = []
+    for token in tokens:
+        if token == SEP:
+            break
+        if token == UNK and kept and kept[-1] == UNK:
+            continue
+        kept.append(token)
+    return kept
+
+
+class PlugSamplingTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        # Peaked like real logits, the top candidates hold the top_p mass
+        self.logits = torch.randn(4, 2048) * 4
+
+    def assert_same_row_by_row(self, top_k, top_p):
+        filtered = DistributedPlug.top_k_logits(
+            self.logits.clone(), top_k=top_k, top_p=top_p)
+        for i in range(self.logits.size(0)):
+            expected = reference_top_k_logits(
+                self.logits[i:i + 1].clone(), top_k=top_k, top_p=top_p)
+            self.assertTrue(torch.equal(filtered[i:i + 1], expected))
+
+    def test_top_k(self):
+        self.assert_same_row_by_row(top_k=50, top_p=0.0)
+
+    def test_top_p(self):
+        self.assert_same_row_by_row(top_k=0, top_p=0.9)
+
+    def test_top_k_with_top_p(self):
+        self.assert_same_row_by_row(top_k=50, top_p=0.9)
+        self.assert_same_row_by_row(top_k=5, top_p=0.5)
+
+    def test_no_op_thresholds(self):
+        for top_k, top_p in ((0, 0.0), (0, 1.0), (self.logits.size(-1), 0.0)):
+            filtered = DistributedPlug.top_k_logits(
+                self.logits.clone(), top_k=top_k, top_p=top_p)
+            self.assertTrue(torch.equal(filtered, self.logits))
+
+    def test_top_k_ties(self):
+        logits = torch.zeros(2, 100)
+        logits[:, :3] = 1.0
+        filtered = DistributedPlug.top_k_logits(logits.clone(), top_k=5)
+        # Exactly top_k tokens are kept, the tied tokens are not all kept
+        self.assertTrue(
+            torch.equal(
+                torch.isfinite(filtered).sum(dim=1), torch.tensor([5, 5])))
+        self.assertTrue(torch.equal(filtered[:, :3], logits[:, :3]))
+        expected = reference_top_k_logits(logits.clone(), top_k=5)
+        kept = torch.isfinite(filtered)
+        self.assertTrue(torch.equal(filtered[kept], expected[kept]))
+
+    def test_top_p_flat_row(self):
+        # The candidates do not reach top_p, the row is cut to the candidates
+        logits = torch.zeros(1, 4096)
+        filtered = DistributedPlug.top_k_logits(logits.clone(), top_p=0.9)
+        self.assertEqual(
+            torch.isfinite(filtered).sum().item(), TOP_P_CANDIDATES)
+
+    def test_trim_generate_tokens(self):
+        tokens = torch.tensor([
+            [5, UNK, UNK, UNK, 6, SEP, 7, 8],
+            [UNK, UNK, 5, UNK, 6, 7, 8, 9],
+            [5, 6, 7, 8, UNK, UNK, SEP, SEP],
+            [SEP, 5, 6, 7, 8, 9, 10, 11],
+        ])
+        self.assertEqual(
+            DistributedPlug.trim_generate_tokens(tokens),
+            [reference_trim(sample) for sample in tokens.tolist()])
+        self.assertEqual(
+            DistributedPlug.trim_generate_tokens(tokens)[:2],
+            [[5, UNK, 6], [UNK, 5, UNK, 6, 7, 8, 9]])
+
+
+if __name__ == '__main__':
+    unittest.main()